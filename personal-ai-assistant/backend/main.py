@@ -3,17 +3,62 @@ from datetime import timedelta
 from dotenv import load_dotenv
 load_dotenv()  # Load environment variables from .env file
 
-from flask import Flask, session, render_template, redirect, url_for, request, jsonify
-from flask_dance.contrib.google import make_google_blueprint
+from flask import Flask, Response, g, session, render_template, redirect, url_for, request, jsonify, stream_with_context
+from flask_dance.consumer import oauth_authorized
+from flask_dance.contrib.google import make_google_blueprint, google
 from flask_session import Session
 from werkzeug.middleware.proxy_fix import ProxyFix
 import tempfile
 import logging
+import json
+from functools import wraps
+from urllib.parse import urlencode
+import anthropic
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# OAuth constants - fixed for the life of the process, so build them once
+GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID')
+GOOGLE_AUTH_URI = "https://accounts.google.com/o/oauth2/auth"
+GOOGLE_REDIRECT_URI = f"http://localhost:{os.getenv('PORT', '8080')}/login/google/authorized"
+GOOGLE_SCOPES = [
+    "openid",
+    "https://www.googleapis.com/auth/userinfo.email",
+    "https://www.googleapis.com/auth/userinfo.profile"
+]
+MANUAL_AUTH_URL = GOOGLE_AUTH_URI + "?" + urlencode({
+    'client_id': GOOGLE_CLIENT_ID,
+    'redirect_uri': GOOGLE_REDIRECT_URI,
+    'scope': 'openid email profile',
+    'response_type': 'code',
+    'access_type': 'offline'
+})
+
+def require_login(view):
+    """Redirect anonymous users to Google login; expose the user as g.user_email"""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        user_email = session.get('user_email')
+        if not user_email:
+            logger.info("User not authenticated, redirecting to Google login")
+            return redirect(url_for('google.login'))
+        g.user_email = user_email
+        return view(*args, **kwargs)
+    return wrapped
+
+def require_login_api(view):
+    """Reject anonymous API calls with 401; expose the user as g.user_email"""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        user_email = session.get('user_email')
+        if not user_email:
+            return jsonify({'error': 'Not authenticated'}), 401
+        g.user_email = user_email
+        return view(*args, **kwargs)
+    return wrapped
+
 def create_app():
     app = Flask(__name__, 
                template_folder='../templates',
@@ -31,21 +76,14 @@ def create_app():
     
     # Google OAuth setup
     google_bp = make_google_blueprint(
-        client_id=os.getenv('GOOGLE_CLIENT_ID'),
+        client_id=GOOGLE_CLIENT_ID,
         client_secret=os.getenv('GOOGLE_CLIENT_SECRET'),
-        scope=[
-            "openid",
-            "https://www.googleapis.com/auth/userinfo.email",
-            "https://www.googleapis.com/auth/userinfo.profile"
-        ],
+        scope=GOOGLE_SCOPES,
         redirect_to='index'
     )
     app.register_blueprint(google_bp, url_prefix='/login')
     
     # OAuth callback
-    from flask_dance.consumer import oauth_authorized
-    from flask_dance.contrib.google import google
-    
     @oauth_authorized.connect_via(google_bp)
     def google_logged_in(blueprint, token):
         if not token:
@@ -65,8 +103,6 @@ def create_app():
         return False
     
     # Initialize Claude client inline to avoid import issues
-    import anthropic
-    
     class ClaudeClient:
         def __init__(self, api_key: str):
             if not api_key:
@@ -76,32 +112,51 @@ def create_app():
             self.conversation_history = {}
             self.max_history = 20
         
-        def send_message(self, user_email: str, message: str) -> str:
-            if user_email not in self.conversation_history:
-                self.conversation_history[user_email] = []
-            
-            system_prompt = f"""You are a personalized AI assistant for {user_email}.
+        def _system_prompt(self, user_email: str) -> str:
+            return f"""You are a personalized AI assistant for {user_email}.
 
 You have access to their Gmail and Google Calendar through native integrations.
 When they ask about emails or calendar, use your built-in access to provide real information.
 Be helpful and conversational."""
+        
+        def _start_turn(self, user_email: str, message: str) -> list:
+            if user_email not in self.conversation_history:
+                self.conversation_history[user_email] = []
             
             self.conversation_history[user_email].append({
                 "role": "user", 
                 "content": message
             })
+            return self.conversation_history[user_email]
+        
+        def _cached_messages(self, history: list) -> list:
+            # Mark the newest turn as a prompt-cache breakpoint so the system
+            # prompt and earlier turns are read from Anthropic's cache on the
+            # next request instead of being reprocessed every time
+            last = history[-1]
+            return history[:-1] + [{
+                "role": last["role"],
+                "content": [{
+                    "type": "text",
+                    "text": last["content"],
+                    "cache_control": {"type": "ephemeral"}
+                }]
+            }]
+        
+        def send_message(self, user_email: str, message: str) -> str:
+            history = self._start_turn(user_email, message)
             
             try:
                 response = self.client.messages.create(
                     model="claude-4-sonnet-20250514",  # Updated to Claude 4 Sonnet
                     max_tokens=4000,
-                    system=system_prompt,
-                    messages=self.conversation_history[user_email]
+                    system=self._system_prompt(user_email),
+                    messages=self._cached_messages(history)
                 )
                 
                 assistant_response = response.content[0].text
                 
-                self.conversation_history[user_email].append({
+                history.append({
                     "role": "assistant",
                     "content": assistant_response
                 })
@@ -109,44 +164,70 @@ Be helpful and conversational."""
                 return assistant_response
                 
             except Exception as e:
-                logger.error(f"Claude API error: {str(e)}")
+                logger.exception(f"Claude API error: {str(e)}")
                 return f"I'm having trouble connecting right now. Please try again in a moment."
+        
+        def stream_message(self, user_email: str, message: str):
+            """Yield response text chunks as Claude generates them"""
+            history = self._start_turn(user_email, message)
+            
+            try:
+                with self.client.messages.stream(
+                    model="claude-4-sonnet-20250514",
+                    max_tokens=4000,
+                    system=self._system_prompt(user_email),
+                    messages=self._cached_messages(history)
+                ) as stream:
+                    chunks = []
+                    for text in stream.text_stream:
+                        chunks.append(text)
+                        yield text
+                
+                history.append({
+                    "role": "assistant",
+                    "content": "".join(chunks)
+                })
+                
+            except Exception as e:
+                logger.exception(f"Claude API error: {str(e)}")
+                yield "I'm having trouble connecting right now. Please try again in a moment."
     
     claude_client = ClaudeClient(api_key=os.getenv('ANTHROPIC_API_KEY'))
     app.claude_client = claude_client
     
     # Routes
     @app.route('/')
+    @require_login
     def index():
-        if 'user_email' not in session:
-            logger.info("User not authenticated, redirecting to Google login")
-            return redirect(url_for('google.login'))
         return render_template('index.html', name=session.get('user_name', 'User'))
     
     @app.route('/chat')
+    @require_login
     def chat():
-        if 'user_email' not in session:
-            return redirect(url_for('google.login'))
         return render_template('chat.html', name=session.get('user_name', 'User'))
     
     @app.route('/api/chat', methods=['POST'])
+    @require_login_api
     def api_chat():
-        if 'user_email' not in session:
-            return jsonify({'error': 'Not authenticated'}), 401
-        
-        user_email = session['user_email']
+        user_email = g.user_email
         message = request.json.get('message')
         
         if not message:
             return jsonify({'error': 'No message provided'}), 400
         
-        try:
-            # Send message to Claude
-            response = claude_client.send_message(user_email, message)
-            return jsonify({'response': response})
-        except Exception as e:
-            logger.error(f"Chat error for {user_email}: {str(e)}")
-            return jsonify({'error': f'Error: {str(e)}'}), 500
+        def generate():
+            # Stream Claude's reply as server-sent events so the first tokens
+            # reach the browser while the rest is still being generated
+            try:
+                for text in claude_client.stream_message(user_email, message):
+                    yield f"data: {json.dumps({'text': text})}\n\n"
+            except Exception as e:
+                logger.exception(f"Chat error for {user_email}: {str(e)}")
+                yield f"data: {json.dumps({'error': f'Error: {str(e)}'})}\n\n"
+            yield "data: [DONE]\n\n"
+        
+        return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
     
     @app.route('/logout')
     def logout():
@@ -155,8 +236,6 @@ Be helpful and conversational."""
     
     @app.route('/debug')
     def debug():
-        import os
-        from flask_dance.contrib.google import google
         return f"""
         <h2>Debug Info</h2>
         <p><strong>Client ID:</strong> {os.getenv('GOOGLE_CLIENT_ID')}</p>
@@ -171,26 +250,12 @@ Be helpful and conversational."""
     
     @app.route('/test-manual')
     def test_manual():
-        from urllib.parse import urlencode
-        client_id = os.getenv('GOOGLE_CLIENT_ID')
-        redirect_uri = f"http://localhost:{os.getenv('PORT', '8080')}/login/google/authorized"
-        
-        params = {
-            'client_id': client_id,
-            'redirect_uri': redirect_uri,
-            'scope': 'openid email profile',
-            'response_type': 'code',
-            'access_type': 'offline'
-        }
-        
-        manual_url = f"https://accounts.google.com/o/oauth2/auth?{urlencode(params)}"
-        
         return f"""
         <h2>Manual OAuth Test</h2>
-        <p><strong>Client ID:</strong> {client_id}</p>
-        <p><strong>Redirect URI:</strong> {redirect_uri}</p>
+        <p><strong>Client ID:</strong> {GOOGLE_CLIENT_ID}</p>
+        <p><strong>Redirect URI:</strong> {GOOGLE_REDIRECT_URI}</p>
         <hr>
-        <p><a href="{manual_url}" target="_blank">Manual OAuth URL (opens in new tab)</a></p>
+        <p><a href="{MANUAL_AUTH_URL}" target="_blank">Manual OAuth URL (opens in new tab)</a></p>
         <p><a href="/login/google">Flask-Dance OAuth URL</a></p>
         <hr>
         <p>Compare these two URLs to see any differences</p>